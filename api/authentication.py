@@ -4,10 +4,51 @@ from rest_framework import exceptions
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
+from users.sharding import get_user_shard
+
 
 User = get_user_model()
 
 
+class UserPrincipal:
+    # Lightweight request.user, the full MyUser row is loaded on first access
+    # to any attribute beyond the projected columns.
+    __slots__ = ("id", "is_active", "is_staff", "token_version", "_shard", "_user")
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, is_active, is_staff, token_version, shard):
+        self.id = id
+        self.is_active = is_active
+        self.is_staff = is_staff
+        self.token_version = token_version
+        self._shard = shard
+        self._user = None
+
+    @property
+    def pk(self):
+        return self.id
+
+    def get_user(self, *fields):
+        if self._user is None:
+            users = User.objects.using(self._shard)
+            if fields:
+                users = users.only(*fields)
+            self._user = users.get(id=self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # Private and dunder lookups (copy, pickle, unset slots) must not
+        # load the user, or they recurse through get_user() on a bare instance.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __str__(self):
+        return str(self.id)
+
+
 class JWTAuthentication(BaseAuthentication):
     def authenticate(self, request):
         authorization_header = request.headers.get("Authorization")
@@ -26,10 +67,19 @@ class JWTAuthentication(BaseAuthentication):
         except IndexError:
             raise exceptions.AuthenticationFailed("Token prefix missing")
 
-        user = User.objects.filter(id=access_token_payload.get("user_id")).first()
-        if user is None:
+        user_id = access_token_payload.get("user_id")
+        shard = get_user_shard(user_id)
+        user_data = (
+            User.objects.using(shard)
+            .filter(id=user_id)
+            .values("is_active", "is_staff", "token_version")
+            .first()
+        )
+        if user_data is None:
             raise exceptions.AuthenticationFailed("User not found")
-        if not user.is_active:
+        if not user_data["is_active"]:
             raise exceptions.AuthenticationFailed("User is inactive")
+        if access_token_payload.get("token_version") != user_data["token_version"]:
+            raise exceptions.AuthenticationFailed("Access token revoked")
 
-        return (user, None)
+        return (UserPrincipal(id=user_id, shard=shard, **user_data), None)
@@ -0,0 +1,28 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+token_write_lock = threading.Lock()
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+@contextmanager
+def token_write():
+    # Token updates are single conditional UPDATEs that autocommit, so they
+    # hold the SQLite write lock only for that statement. Optionally they, and
+    # the refresh grace cache insert, are also queued in-process to keep
+    # concurrent rotations off the lock.
+    if not settings.SQLITE_SERIALIZE_TOKEN_WRITES:
+        yield
+        return
+    with token_write_lock:
+        yield
@@ -0,0 +1,7 @@
+from rest_framework import exceptions, status
+
+
+class PreconditionFailed(exceptions.APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = "The profile was modified, please reload it and try again."
+    default_code = "precondition_failed"
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from api.utils import generate_refresh_token
+from users.models import UserDirectory
+from users.sharding import get_user_shards
+
+
+User = get_user_model()
+
+BENCH_USERNAME_PREFIX = "bench_refresh_"
+
+
+class Command(BaseCommand):
+    help = "Measure sustained /api/refresh/ throughput with concurrent clients."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        threads = options["threads"]
+        duration = options["duration"]
+        users = [
+            User.objects.create_user(
+                username=f"{BENCH_USERNAME_PREFIX}{i}", password="bench"
+            )
+            for i in range(threads)
+        ]
+        for user in users:
+            generate_refresh_token(user)
+        results = []
+        deadline = time.monotonic() + duration
+
+        def worker(user):
+            client = Client(SERVER_NAME="localhost", raise_request_exception=False)
+            refresh_token = user.refresh_token
+            latencies, errors = [], 0
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                response = client.post(
+                    reverse("api:refresh"),
+                    {"refresh_token": refresh_token},
+                    content_type="application/json",
+                )
+                latencies.append(time.perf_counter() - started)
+                if response.status_code == 201:
+                    refresh_token = response.json()["refresh_token"]
+                else:
+                    errors += 1
+            results.append((latencies, errors))
+            connection.close()
+
+        workers = [threading.Thread(target=worker, args=(user,)) for user in users]
+        try:
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            for shard in get_user_shards():
+                User.objects.using(shard).filter(
+                    username__startswith=BENCH_USERNAME_PREFIX
+                ).delete()
+            UserDirectory.objects.using(settings.USER_DIRECTORY_DATABASE).filter(
+                username__startswith=BENCH_USERNAME_PREFIX
+            ).delete()
+
+        latencies = sorted(latency for result in results for latency in result[0])
+        errors = sum(result[1] for result in results)
+        if not latencies:
+            self.stdout.write("No requests completed.")
+            return
+        self.stdout.write(
+            f"threads={threads} requests={len(latencies)} errors={errors} "
+            f"throughput={len(latencies) / elapsed:.1f} req/s "
+            f"p50={latencies[len(latencies) // 2] * 1000:.2f}ms "
+            f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms"
+        )
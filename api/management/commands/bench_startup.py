@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from users.models import UserDirectory
+from users.sharding import get_user_shards
+
+
+User = get_user_model()
+
+BENCH_USERNAME = "bench_startup"
+BENCH_PASSWORD = "bench_startup"
+
+# Runs in a fresh interpreter so nothing is imported or connected beforehand.
+WORKER_SCRIPT = f"""
+import json
+import os
+import time
+
+started = time.perf_counter()
+from restapi.wsgi import application
+from django.test import Client
+
+if os.environ["API_WARMUP"] == "1":
+    from api.warmup import warm_connections
+
+    warm_connections()
+
+run = {{"startup": (time.perf_counter() - started) * 1000}}
+client = Client(SERVER_NAME="localhost")
+
+started = time.perf_counter()
+response = client.post(
+    "/api/login/",
+    {{"username": "{BENCH_USERNAME}", "password": "{BENCH_PASSWORD}"}},
+    content_type="application/json",
+)
+run["login"] = (time.perf_counter() - started) * 1000
+
+access_token = response.json()["access_token"]
+started = time.perf_counter()
+client.get("/api/me/", HTTP_AUTHORIZATION=f"Bearer {{access_token}}")
+run["me"] = (time.perf_counter() - started) * 1000
+
+print(json.dumps(run))
+"""
+
+
+class Command(BaseCommand):
+    help = "Measure worker startup and first-request latency with and without warmup."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=3)
+
+    def handle(self, *args, **options):
+        User.objects.create_user(username=BENCH_USERNAME, password=BENCH_PASSWORD)
+        try:
+            for warmup in (False, True):
+                runs = [self.run_worker(warmup) for _ in range(options["runs"])]
+                medians = {
+                    key: sorted(run[key] for run in runs)[len(runs) // 2]
+                    for key in runs[0]
+                }
+                self.stdout.write(
+                    f"warmup={warmup} "
+                    + " ".join(f"{key}={value:.1f}ms" for key, value in medians.items())
+                )
+        finally:
+            for shard in get_user_shards():
+                User.objects.using(shard).filter(username=BENCH_USERNAME).delete()
+            UserDirectory.objects.using(settings.USER_DIRECTORY_DATABASE).filter(
+                username=BENCH_USERNAME
+            ).delete()
+
+    def run_worker(self, warmup):
+        env = dict(os.environ, API_WARMUP="1" if warmup else "0")
+        output = subprocess.run(
+            [sys.executable, "-c", WORKER_SCRIPT],
+            cwd=settings.BASE_DIR,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return json.loads(output)
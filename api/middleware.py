@@ -0,0 +1,109 @@
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+
+
+route_classes = {}
+
+
+class RouteClass:
+    def __init__(self, name, max_concurrency, queue_timeout):
+        self.name = name
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.Semaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.metrics = {
+            "admitted": 0,
+            "queued": 0,
+            "shed": 0,
+            "in_flight": 0,
+            "queue_depth": 0,
+        }
+
+    def count(self, **deltas):
+        with self.lock:
+            for metric, delta in deltas.items():
+                self.metrics[metric] += delta
+
+    def acquire(self, timeout):
+        # A free slot is always taken, only a saturated class waits for at
+        # most timeout seconds, and timeout <= 0 means never queue.
+        if self.semaphore.acquire(blocking=False):
+            self.count(admitted=1, in_flight=1)
+            return True
+        if timeout <= 0:
+            self.count(shed=1)
+            return False
+
+        self.count(queued=1, queue_depth=1)
+        if self.semaphore.acquire(timeout=timeout):
+            self.count(admitted=1, in_flight=1, queue_depth=-1)
+            return True
+        self.count(shed=1, queue_depth=-1)
+        return False
+
+    def release(self):
+        self.semaphore.release()
+        self.count(in_flight=-1)
+
+
+def get_request_queue_time(request):
+    # X-Request-Start is set by the proxy in front of the workers, as
+    # "t=<timestamp>" in seconds, milliseconds or microseconds.
+    request_start = request.headers.get("X-Request-Start", "").strip()
+    if request_start.startswith("t="):
+        request_start = request_start[2:]
+    try:
+        started = float(request_start)
+    except ValueError:
+        return 0
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(time.time() - started, 0)
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.view_route_classes = {}
+        for name, config in settings.ADMISSION_CONTROL.items():
+            route_class = RouteClass(
+                name, config["max_concurrency"], config["queue_timeout"]
+            )
+            route_classes[name] = route_class
+            for view_name in config["views"]:
+                self.view_route_classes[view_name] = route_class
+
+    def __call__(self, request):
+        try:
+            view_name = resolve(request.path_info).view_name
+        except Resolver404:
+            return self.get_response(request)
+        route_class = self.view_route_classes.get(view_name)
+        if route_class is None:
+            return self.get_response(request)
+
+        queue_time = get_request_queue_time(request)
+        if queue_time > route_class.queue_timeout:
+            # The client has already waited past the deadline in front of us.
+            route_class.count(shed=1)
+            return self.overloaded_response()
+        if not route_class.acquire(route_class.queue_timeout - queue_time):
+            return self.overloaded_response()
+        try:
+            return self.get_response(request)
+        finally:
+            route_class.release()
+
+    def overloaded_response(self):
+        response = JsonResponse(
+            {"detail": "Server is overloaded, please try again later."},
+            status=503,
+        )
+        response["Retry-After"] = "1"
+        return response
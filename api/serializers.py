@@ -1,6 +1,14 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from users.models import UserDirectory
+from users.sharding import is_sharding_enabled
+
+from .exceptions import PreconditionFailed
 
 
 User = get_user_model()
@@ -13,9 +21,80 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ["id", "username", "email", "password"]
 
+    def validate_username(self, value):
+        if is_sharding_enabled():
+            directory = UserDirectory.objects.using(settings.USER_DIRECTORY_DATABASE)
+            if self.instance is not None:
+                directory = directory.exclude(id=self.instance.id)
+            if directory.filter(username=value).exists():
+                raise serializers.ValidationError(
+                    "A user with that username already exists."
+                )
+        return value
+
     def create(self, validated_data):
-        validated_data["password"] = make_password(validated_data["password"])
-        return super().create(validated_data)
+        return User.objects.create_user(**validated_data)
+
+    def rename_in_directory(self, user_id, username):
+        # The directory's unique constraint is the global username check, a
+        # name taken since validate_username is a validation error, not a 500.
+        try:
+            with transaction.atomic(using=settings.USER_DIRECTORY_DATABASE):
+                UserDirectory.objects.using(settings.USER_DIRECTORY_DATABASE).filter(
+                    id=user_id
+                ).update(username=username)
+        except IntegrityError:
+            raise serializers.ValidationError(
+                {"username": ["A user with that username already exists."]}
+            )
+
+    def update(self, instance, validated_data):
+        # Only changed columns are written, in a single UPDATE that is
+        # conditional on the row version when the client sent If-Match.
+        expected_versions = self.context.get("expected_versions")
+        # A new password is always written, its hash is salted and comparing
+        # it would only load the deferred password column.
+        if "password" in validated_data:
+            validated_data["password"] = make_password(validated_data["password"])
+        changed_fields = {
+            field: value
+            for field, value in validated_data.items()
+            if field == "password" or getattr(instance, field) != value
+        }
+        if not changed_fields:
+            if expected_versions is not None and (
+                instance.version not in expected_versions
+            ):
+                raise PreconditionFailed()
+            return instance
+
+        renamed = is_sharding_enabled() and "username" in changed_fields
+        if renamed:
+            self.rename_in_directory(instance.id, changed_fields["username"])
+
+        users = User.objects.using(instance._state.db).filter(id=instance.id)
+        if expected_versions is not None:
+            users = users.filter(version__in=expected_versions)
+        try:
+            updated = users.update(version=F("version") + 1, **changed_fields)
+        except Exception:
+            if renamed:
+                self.rename_in_directory(instance.id, instance.username)
+            raise
+        if not updated:
+            if renamed:
+                self.rename_in_directory(instance.id, instance.username)
+            raise PreconditionFailed()
+
+        for field, value in changed_fields.items():
+            setattr(instance, field, value)
+        # An unconditional write may have raced other edits, so the new
+        # version is only known when the UPDATE was filtered on a single one.
+        if expected_versions is not None and len(expected_versions) == 1:
+            instance.version = next(iter(expected_versions)) + 1
+        else:
+            instance.version = None
+        return instance
 
 
 class UserUUIDSerializer(serializers.ModelSerializer):
@@ -24,3 +103,17 @@ class UserUUIDSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ["refresh_token"]
+
+
+class RevokeTokensSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, required=False
+    )
+    issued_before = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError(
+                "Please provide user_ids or issued_before"
+            )
+        return attrs
@@ -1,15 +1,39 @@
+import copy
+import pickle
 import uuid
 import time
+from datetime import timedelta
+from io import StringIO
 
-from django.test import TestCase
+from unittest import mock, skipUnless
+
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework import status
-from rest_framework.test import APIClient
+from rest_framework import exceptions, status
+from rest_framework.test import APIClient, APIRequestFactory
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError, connections
 from django.utils import timezone
 
-from .utils import generate_access_token, generate_refresh_token
+from users.models import UserDirectory
+from users.sharding import get_user_shard, get_username_shard
+
+from .authentication import JWTAuthentication, UserPrincipal
+from .exceptions import PreconditionFailed
+from .middleware import RouteClass
+from .serializers import UserSerializer
+from .utils import (
+    generate_access_token,
+    generate_refresh_token,
+    get_refresh_grace_cache,
+    get_refresh_grace_cache_key,
+    rotate_token_pair,
+)
+from .views import get_user_by_refresh_token
+from .warmup import warm_connections, warmup
 
 
 VALID_REG_DATA = {
@@ -28,6 +52,8 @@ User = get_user_model()
 
 
 class UserCommonTestFunctionality(TestCase):
+    databases = "__all__"
+
     def setUp(self):
         self.client = APIClient()
         self.user = User.objects.create_user(
@@ -36,6 +62,8 @@ class UserCommonTestFunctionality(TestCase):
 
 
 class UserRegistrationTestCase(TestCase):
+    databases = "__all__"
+
     def setUp(self):
         self.client = APIClient()
 
@@ -44,8 +72,11 @@ class UserRegistrationTestCase(TestCase):
             reverse("api:register"), VALID_REG_DATA, format="json"
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        shard = get_username_shard(VALID_REG_DATA["username"])
         self.assertTrue(
-            User.objects.filter(username=VALID_REG_DATA["username"]).exists()
+            User.objects.using(shard)
+            .filter(username=VALID_REG_DATA["username"])
+            .exists()
         )
 
     def test_user_registration_failure(self):
@@ -80,10 +111,45 @@ class UserProfileViewTestCase(UserCommonTestFunctionality):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["username"], self.user.username)
 
+    def test_authenticated_user_profile_view_query_count(self):
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        with CaptureQueriesContext(connections[self.user._state.db]) as queries:
+            response = self.client.get(reverse("api:detail"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn("password", queries[1]["sql"])
+
     def test_unauthenticated_user_profile_view(self):
         response = self.client.get(reverse("api:detail"))
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_authentication_loads_full_user_lazily(self):
+        access_token = generate_access_token(self.user)
+        request = APIRequestFactory().get(
+            reverse("api:detail"), HTTP_AUTHORIZATION=f"Bearer {access_token}"
+        )
+        with self.assertNumQueries(1, using=self.user._state.db):
+            principal, _ = JWTAuthentication().authenticate(request)
+        self.assertIsInstance(principal, UserPrincipal)
+        self.assertEqual(principal.id, self.user.id)
+        with self.assertNumQueries(1, using=self.user._state.db):
+            self.assertEqual(principal.username, self.user.username)
+
+    def test_principal_copy_and_pickle(self):
+        principal = UserPrincipal(
+            id=self.user.id,
+            is_active=True,
+            is_staff=False,
+            token_version=0,
+            shard=self.user._state.db,
+        )
+        for clone in (copy.copy(principal), pickle.loads(pickle.dumps(principal))):
+            self.assertEqual(clone.id, self.user.id)
+            self.assertEqual(clone.username, self.user.username)
+        with self.assertRaises(AttributeError):
+            UserPrincipal.__new__(UserPrincipal).username
+
 
 class UserProfileUpdateTestCase(UserCommonTestFunctionality):
     DATA = VALID_REG_DATA
@@ -94,7 +160,10 @@ class UserProfileUpdateTestCase(UserCommonTestFunctionality):
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
         response = self.client.post(reverse("api:detail"), self.DATA, format="json")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(User.objects.count(), 1)
+        self.assertEqual(
+            sum(User.objects.using(shard).count() for shard in settings.USER_SHARDS),
+            1,
+        )
         self.assertEqual(response.data["username"], self.user.username)
 
     def test_unauthenticated_user_profile_view(self):
@@ -102,6 +171,97 @@ class UserProfileUpdateTestCase(UserCommonTestFunctionality):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+class UserProfileConditionalUpdateTestCase(UserCommonTestFunctionality):
+    def setUp(self):
+        super().setUp()
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+
+    def test_update_with_matching_etag_success(self):
+        etag = self.client.get(reverse("api:detail"))["ETag"]
+        response = self.client.post(
+            reverse("api:detail"),
+            {"email": "updated@example.com"},
+            format="json",
+            HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "updated@example.com")
+
+    def test_update_with_etag_list_containing_current_version_success(self):
+        etag = self.client.get(reverse("api:detail"))["ETag"]
+        response = self.client.post(
+            reverse("api:detail"),
+            {"email": "updated@example.com"},
+            format="json",
+            HTTP_IF_MATCH=f'"41", {etag}, "not-a-version"',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "updated@example.com")
+
+    def test_update_with_etag_list_without_current_version_failed(self):
+        response = self.client.post(
+            reverse("api:detail"),
+            {"email": "updated@example.com"},
+            format="json",
+            HTTP_IF_MATCH='"41", "42"',
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_with_weak_etag_failed(self):
+        response = self.client.post(
+            reverse("api:detail"),
+            {"email": "updated@example.com"},
+            format="json",
+            HTTP_IF_MATCH='W/"0"',
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, VALID_REG_DATA["email"])
+
+    def test_update_with_stale_etag_failed(self):
+        etag = self.client.get(reverse("api:detail"))["ETag"]
+        self.client.post(
+            reverse("api:detail"), {"email": "first@example.com"}, format="json"
+        )
+        response = self.client.post(
+            reverse("api:detail"),
+            {"email": "second@example.com"},
+            format="json",
+            HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "first@example.com")
+
+    def test_unconditional_update_after_concurrent_edit_omits_etag(self):
+        User.objects.using(self.user._state.db).filter(id=self.user.id).update(
+            version=5
+        )
+        response = self.client.post(
+            reverse("api:detail"), {"email": "updated@example.com"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("ETag", response)
+        etag = self.client.get(reverse("api:detail"))["ETag"]
+        self.assertEqual(etag, '"6"')
+
+    def test_update_keeps_concurrently_rotated_refresh_token(self):
+        stale_user = User.objects.using(self.user._state.db).get(id=self.user.id)
+        refresh_token = generate_refresh_token(self.user)
+        serializer = UserSerializer(
+            stale_user, data={"email": "updated@example.com"}, partial=True
+        )
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.refresh_token, refresh_token)
+        self.assertEqual(self.user.email, "updated@example.com")
+
+
 class UserLoginTestCase(UserCommonTestFunctionality):
     def test_user_login_success(self):
         user_login_data = {
@@ -203,3 +363,300 @@ class UserRefreshTestCase(UserCommonTestFunctionality):
             self.assertEqual(
                 refresh_token_expires_at, self.user.refresh_token_expires_at
             )
+
+
+class UserRefreshGracePeriodTestCase(UserCommonTestFunctionality):
+    def setUp(self):
+        super().setUp()
+        get_refresh_grace_cache().clear()
+
+    def test_repeated_refresh_within_grace_period_returns_same_tokens(self):
+        refresh_token_data = {"refresh_token": generate_refresh_token(self.user)}
+        first_response = self.client.post(
+            reverse("api:refresh"), refresh_token_data, format="json"
+        )
+        self.user.refresh_from_db()
+        rotated_refresh_token = self.user.refresh_token
+        second_response = self.client.post(
+            reverse("api:refresh"), refresh_token_data, format="json"
+        )
+        self.assertEqual(second_response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second_response.data, first_response.data)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.refresh_token, rotated_refresh_token)
+
+    def test_refresh_losing_cache_race_returns_winner_tokens(self):
+        refresh_token = generate_refresh_token(self.user)
+        winner_token_pair = {"access_token": "winner", "refresh_token": uuid.uuid4()}
+        get_refresh_grace_cache().add(
+            get_refresh_grace_cache_key(refresh_token), winner_token_pair
+        )
+        self.assertEqual(rotate_token_pair(self.user), winner_token_pair)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.refresh_token, refresh_token)
+
+    def test_refresh_with_unavailable_cache_success(self):
+        refresh_token_data = {"refresh_token": generate_refresh_token(self.user)}
+        grace_cache = get_refresh_grace_cache()
+        with mock.patch.object(
+            grace_cache, "get", side_effect=DatabaseError
+        ), mock.patch.object(grace_cache, "add", side_effect=DatabaseError):
+            response = self.client.post(
+                reverse("api:refresh"), refresh_token_data, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.refresh_token, response.data["refresh_token"])
+
+    @override_settings(REFRESH_TOKEN_GRACE_PERIOD=timedelta(0))
+    def test_repeated_refresh_without_grace_period_failed(self):
+        refresh_token_data = {"refresh_token": generate_refresh_token(self.user)}
+        response = self.client.post(
+            reverse("api:refresh"), refresh_token_data, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(
+            reverse("api:refresh"), refresh_token_data, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UserTokenRevocationTestCase(UserCommonTestFunctionality):
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user(
+            username="otheruser", email="otheruser@example.com", password="password"
+        )
+
+    def assertTokensRevoked(self, user, access_token):
+        user.refresh_from_db()
+        self.assertEqual(user.refresh_token_expires_at, None)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        response = self.client.get(reverse("api:detail"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_revoke_tokens_by_user_ids(self):
+        access_token = generate_access_token(self.user)
+        generate_refresh_token(self.user)
+        generate_refresh_token(self.other_user)
+        admin = User.objects.create_superuser(
+            username="admin", email="admin@example.com", password="password"
+        )
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {generate_access_token(admin)}"
+        )
+        response = self.client.post(
+            reverse("api:revoke"), {"user_ids": [self.user.id]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["revoked"], 1)
+        self.assertTokensRevoked(self.user, access_token)
+        self.other_user.refresh_from_db()
+        self.assertNotEqual(self.other_user.refresh_token_expires_at, None)
+
+    def test_revoke_tokens_requires_admin(self):
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        response = self.client.post(
+            reverse("api:revoke"), {"user_ids": [self.user.id]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_revocation_between_read_and_rotation_is_kept(self):
+        refresh_token = generate_refresh_token(self.user)
+        user = get_user_by_refresh_token(refresh_token)
+        User.objects.using(user._state.db).filter(id=user.id).revoke_tokens()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            rotate_token_pair(user)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.refresh_token, refresh_token)
+        self.assertEqual(self.user.refresh_token_expires_at, None)
+        response = self.client.post(
+            reverse("api:refresh"), {"refresh_token": refresh_token}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_revoke_tokens_command_by_cutoff(self):
+        access_token = generate_access_token(self.user)
+        generate_refresh_token(self.user)
+        call_command(
+            "revoke_tokens",
+            "--issued-before",
+            (timezone.now() + timedelta(seconds=1)).isoformat(),
+            stdout=StringIO(),
+        )
+        self.assertTokensRevoked(self.user, access_token)
+
+
+@skipUnless(len(settings.USER_SHARDS) > 1, "Run with USER_SHARD_COUNT > 1")
+class UserShardingTestCase(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.client = APIClient()
+        self.users = [
+            User.objects.create_user(
+                username=f"user{i}", email=f"user{i}@example.com", password="password"
+            )
+            for i in range(len(settings.USER_SHARDS) * 4)
+        ]
+
+    def test_users_are_spread_over_shards(self):
+        shards = {user._state.db for user in self.users}
+        self.assertEqual(shards, set(settings.USER_SHARDS))
+        for user in self.users:
+            self.assertEqual(user._state.db, get_user_shard(user.id))
+            self.assertTrue(
+                User.objects.using(get_user_shard(user.id)).filter(id=user.id).exists()
+            )
+
+    def test_login_refresh_and_profile_on_shard(self):
+        for user in self.users:
+            response = self.client.post(
+                reverse("api:login"),
+                {"username": user.username, "password": "password"},
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(
+                reverse("api:refresh"),
+                {"refresh_token": response.data["refresh_token"]},
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.client.credentials(
+                HTTP_AUTHORIZATION=f"Bearer {response.data['access_token']}"
+            )
+            response = self.client.get(reverse("api:detail"))
+            self.assertEqual(response.data["username"], user.username)
+            self.client.credentials()
+
+    def test_rename_to_username_taken_since_validation_failed(self):
+        user, other_user = self.users[0], self.users[1]
+        serializer = UserSerializer(user, data={"username": "renamed"}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        User.objects.using(other_user._state.db).filter(id=other_user.id).update(
+            username="renamed"
+        )
+        UserDirectory.objects.filter(id=other_user.id).update(username="renamed")
+        with self.assertRaises(exceptions.ValidationError):
+            serializer.save()
+        self.assertEqual(UserDirectory.objects.get(id=user.id).username, user.username)
+        self.assertEqual(
+            User.objects.using(user._state.db).get(id=user.id).username, user.username
+        )
+
+    def test_rename_with_stale_version_restores_directory(self):
+        user = self.users[0]
+        serializer = UserSerializer(
+            user,
+            data={"username": "renamed"},
+            partial=True,
+            context={"expected_versions": {user.version + 1}},
+        )
+        self.assertTrue(serializer.is_valid())
+        with self.assertRaises(PreconditionFailed):
+            serializer.save()
+        self.assertEqual(UserDirectory.objects.get(id=user.id).username, user.username)
+        self.assertEqual(get_username_shard("renamed"), None)
+
+    def test_registration_rejects_username_taken_on_another_shard(self):
+        for user in self.users:
+            response = self.client.post(
+                reverse("api:register"),
+                {
+                    "username": user.username,
+                    "email": "another@example.com",
+                    "password": "password",
+                },
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+ADMISSION_CONTROL = {
+    "password": {
+        "views": ["api:login", "api:register"],
+        "max_concurrency": 0,
+        "queue_timeout": 0.1,
+    },
+    "token": {
+        "views": ["api:detail"],
+        "max_concurrency": 1,
+        "queue_timeout": 1.0,
+    },
+}
+
+
+@override_settings(ADMISSION_CONTROL=ADMISSION_CONTROL)
+class AdmissionControlTestCase(UserCommonTestFunctionality):
+    def test_saturated_route_class_is_shed(self):
+        response = self.client.post(
+            reverse("api:login"), VALID_REG_DATA, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        response = self.client.get(reverse("api:detail"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_request_queued_past_deadline_is_shed(self):
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        response = self.client.get(
+            reverse("api:detail"), HTTP_X_REQUEST_START=f"t={time.time() - 5}"
+        )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @override_settings(
+        ADMISSION_CONTROL={
+            "token": {
+                "views": ["api:detail"],
+                "max_concurrency": 1,
+                "queue_timeout": 0,
+            }
+        }
+    )
+    def test_route_class_without_queue_admits_free_slot(self):
+        access_token = generate_access_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access_token}")
+        response = self.client.get(reverse("api:detail"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_route_class_counts_queued_requests(self):
+        route_class = RouteClass("token", max_concurrency=1, queue_timeout=0.01)
+        self.assertTrue(route_class.acquire(0))
+        self.assertFalse(route_class.acquire(0))
+        self.assertFalse(route_class.acquire(0.01))
+        route_class.release()
+        self.assertTrue(route_class.acquire(0))
+        self.assertEqual(
+            route_class.metrics,
+            {"admitted": 2, "queued": 1, "shed": 2, "in_flight": 1, "queue_depth": 0},
+        )
+
+    def test_admission_metrics(self):
+        admin = User.objects.create_superuser(
+            username="admin", email="admin@example.com", password="password"
+        )
+        self.client.post(reverse("api:login"), VALID_REG_DATA, format="json")
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {generate_access_token(admin)}"
+        )
+        self.client.get(reverse("api:detail"))
+        response = self.client.get(reverse("api:metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["password"]["shed"], 1)
+        self.assertEqual(response.data["token"]["admitted"], 1)
+        self.assertEqual(response.data["token"]["in_flight"], 0)
+
+
+class WarmupTestCase(TestCase):
+    databases = "__all__"
+
+    def test_warmup(self):
+        warmup()
+        warm_connections()
+        response = APIClient().get(reverse("api:detail"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -1,6 +1,14 @@
 from django.urls import path
 
-from .views import register_view, profile_view, login_view, logout_view, refresh_token
+from .views import (
+    admission_metrics_view,
+    register_view,
+    profile_view,
+    login_view,
+    logout_view,
+    refresh_token,
+    revoke_tokens_view,
+)
 
 
 app_name = "api"
@@ -11,4 +19,6 @@ urlpatterns = [
     path("login/", login_view, name="login"),
     path("logout/", logout_view, name="logout"),
     path("refresh/", refresh_token, name="refresh"),
+    path("revoke/", revoke_tokens_view, name="revoke"),
+    path("metrics/", admission_metrics_view, name="metrics"),
 ]
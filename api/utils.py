@@ -1,13 +1,28 @@
-import uuid
-
 import jwt
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from django.utils import timezone
+from rest_framework import exceptions
+
+from users.sharding import generate_sharded_uuid
+
+from .db import token_write
+
+
+User = get_user_model()
+
+REFRESH_TOKEN_FIELDS = [
+    "refresh_token",
+    "refresh_token_created_at",
+    "refresh_token_expires_at",
+]
 
 
 def generate_access_token(user):
     access_token_payload = {
         "user_id": user.id,
+        "token_version": user.token_version,
         "exp": timezone.now() + settings.ACCESS_TOKEN_LIFETIME,
         "iat": timezone.now(),
     }
@@ -17,9 +32,106 @@ def generate_access_token(user):
     return access_token
 
 
-def generate_refresh_token(user):
-    user.refresh_token = uuid.uuid4()
+def generate_refresh_token(user, commit=True):
+    user.refresh_token = generate_sharded_uuid(user.id)
     user.refresh_token_created_at = timezone.now()
     user.refresh_token_expires_at = timezone.now() + settings.REFRESH_TOKEN_LIFETIME
-    user.save()
+    if commit:
+        save_refresh_token(user)
     return user.refresh_token
+
+
+def save_refresh_token(user, **conditions):
+    # A set-based UPDATE conditional on the token version, so a concurrent
+    # revocation between reading the user and writing is never undone.
+    with token_write():
+        saved = (
+            User.objects.using(user._state.db)
+            .filter(id=user.id, token_version=user.token_version, **conditions)
+            .update(**{field: getattr(user, field) for field in REFRESH_TOKEN_FIELDS})
+        )
+    if not saved:
+        raise exceptions.AuthenticationFailed(
+            "Expired refresh token, please login again."
+        )
+
+
+def clear_refresh_token(user):
+    with token_write():
+        User.objects.using(user._state.db).filter(
+            id=user.id, refresh_token=user.refresh_token
+        ).update(refresh_token_created_at=None, refresh_token_expires_at=None)
+
+
+def get_refresh_grace_cache():
+    return caches[settings.REFRESH_TOKEN_GRACE_CACHE]
+
+
+def get_refresh_grace_cache_key(refresh_token):
+    return f"refresh_grace:{refresh_token}"
+
+
+def get_rotated_token_pair(refresh_token):
+    # The grace window only collapses repeated refreshes, an unavailable cache
+    # must not fail them.
+    try:
+        return get_refresh_grace_cache().get(get_refresh_grace_cache_key(refresh_token))
+    except Exception:
+        return None
+
+
+def discard_rotated_token_pair(refresh_token):
+    try:
+        get_refresh_grace_cache().delete(get_refresh_grace_cache_key(refresh_token))
+    except Exception:
+        pass
+
+
+def rotate_token_pair(user):
+    # Concurrent refreshes with the same token race for the grace cache key,
+    # only the winner writes the new refresh token to the database and the
+    # others get back the pair it issued.
+    previous_refresh_token = user.refresh_token
+    conditions = {
+        "refresh_token": previous_refresh_token,
+        "refresh_token_expires_at__gt": timezone.now(),
+    }
+    token_pair = {
+        "access_token": generate_access_token(user),
+        "refresh_token": generate_refresh_token(user, commit=False),
+    }
+
+    grace_period = settings.REFRESH_TOKEN_GRACE_PERIOD.total_seconds()
+    try:
+        with token_write():
+            added = grace_period > 0 and get_refresh_grace_cache().add(
+                get_refresh_grace_cache_key(previous_refresh_token),
+                token_pair,
+                grace_period,
+            )
+    except Exception:
+        grace_period = 0
+    if grace_period <= 0:
+        save_refresh_token(user, **conditions)
+        return token_pair
+
+    if not added:
+        rotated_token_pair = get_rotated_token_pair(previous_refresh_token)
+        if rotated_token_pair is not None:
+            return rotated_token_pair
+    try:
+        save_refresh_token(user, **conditions)
+    except exceptions.AuthenticationFailed:
+        rotated_token_pair = (
+            None if added else get_rotated_token_pair(previous_refresh_token)
+        )
+        if rotated_token_pair is not None:
+            return rotated_token_pair
+        if added:
+            discard_rotated_token_pair(previous_refresh_token)
+        raise
+    except Exception:
+        if added:
+            discard_rotated_token_pair(previous_refresh_token)
+        raise
+    return token_pair
@@ -4,28 +4,76 @@ from django.contrib.auth import get_user_model
 from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import exceptions, status
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.decorators import api_view, permission_classes
 
-from .serializers import UserSerializer, UserUUIDSerializer
-from .utils import generate_access_token, generate_refresh_token
+from users.sharding import (
+    get_refresh_token_shard,
+    get_username_shard,
+    get_user_shard,
+    get_user_shards,
+)
+
+from .middleware import route_classes
+from .serializers import RevokeTokensSerializer, UserSerializer, UserUUIDSerializer
+from .utils import (
+    clear_refresh_token,
+    generate_access_token,
+    generate_refresh_token,
+    get_rotated_token_pair,
+    rotate_token_pair,
+)
 
 
 User = get_user_model()
 
+PROFILE_FIELDS = ["id", "username", "email", "version"]
 
-def get_user_from_serialized_refresh_token(request):
+
+def get_serialized_refresh_token(request):
     serializer = UserUUIDSerializer(data=request.data)
     if serializer.is_valid():
-        refresh_token_data = serializer.validated_data.get("refresh_token")
-        user = User.objects.filter(refresh_token=refresh_token_data).first()
-        if user is None:
-            raise exceptions.ValidationError("Please provide the correct refresh token")
-        return user
+        return serializer.validated_data.get("refresh_token")
     else:
         raise exceptions.ValidationError(serializer.errors)
 
 
+def get_user_by_refresh_token(refresh_token_data):
+    shard = get_refresh_token_shard(refresh_token_data)
+    user = None
+    if shard is not None:
+        user = (
+            User.objects.using(shard).filter(refresh_token=refresh_token_data).first()
+        )
+    if user is None:
+        raise exceptions.ValidationError("Please provide the correct refresh token")
+    return user
+
+
+def get_user_from_serialized_refresh_token(request):
+    refresh_token_data = get_serialized_refresh_token(request)
+    return get_user_by_refresh_token(refresh_token_data)
+
+
+def get_if_match_versions(request):
+    # If-Match holds "*" or a comma-separated list of entity tags, entries
+    # that are not profile versions can never match.
+    if_match = request.headers.get("If-Match", "*")
+    versions = set()
+    for entity_tag in if_match.split(","):
+        entity_tag = entity_tag.strip()
+        if entity_tag == "*":
+            return None
+        if entity_tag.startswith("W/"):
+            # If-Match uses strong comparison, weak tags never match.
+            continue
+        try:
+            versions.add(int(entity_tag.strip('"')))
+        except ValueError:
+            continue
+    return versions
+
+
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def register_view(request):
@@ -38,17 +86,25 @@ def register_view(request):
 
 @api_view(["GET", "POST"])
 def profile_view(request):
-    user = request.user
+    user = request.user.get_user(*PROFILE_FIELDS)
 
     if request.method == "GET":
         serializer = UserSerializer(user)
-        return Response(serializer.data)
+        return Response(serializer.data, headers={"ETag": f'"{user.version}"'})
 
     elif request.method == "POST":
-        serializer = UserSerializer(user, data=request.data, partial=True)
+        serializer = UserSerializer(
+            user,
+            data=request.data,
+            partial=True,
+            context={"expected_versions": get_if_match_versions(request)},
+        )
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data)
+            response = Response(serializer.data)
+            if user.version is not None:
+                response["ETag"] = f'"{user.version}"'
+            return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -61,7 +117,10 @@ def login_view(request):
     if (username is None) or (password is None):
         raise exceptions.AuthenticationFailed("Please enter username and password")
 
-    user = User.objects.filter(username=username).first()
+    shard = get_username_shard(username)
+    user = None
+    if shard is not None:
+        user = User.objects.using(shard).filter(username=username).first()
     if user is None:
         raise exceptions.AuthenticationFailed(
             "Please enter the correct username and password!"
@@ -86,29 +145,59 @@ def login_view(request):
 @permission_classes([AllowAny])
 def logout_view(request):
     user = get_user_from_serialized_refresh_token(request)
-    user.refresh_token_created_at = None
-    user.refresh_token_expires_at = None
-    user.save()
+    clear_refresh_token(user)
     return Response({"success": "User logged out."})
 
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def refresh_token(request):
-    user = get_user_from_serialized_refresh_token(request)
+    refresh_token_data = get_serialized_refresh_token(request)
+    token_pair = get_rotated_token_pair(refresh_token_data)
+    if token_pair is not None:
+        return Response(data=token_pair, status=status.HTTP_201_CREATED)
+
+    try:
+        user = get_user_by_refresh_token(refresh_token_data)
+    except exceptions.ValidationError:
+        # A concurrent refresh may have rotated the token after the cache check.
+        token_pair = get_rotated_token_pair(refresh_token_data)
+        if token_pair is None:
+            raise
+        return Response(data=token_pair, status=status.HTTP_201_CREATED)
+
     expire_time = user.refresh_token_expires_at
     if expire_time is None or expire_time < timezone.now():
         raise exceptions.AuthenticationFailed(
             "Expired refresh token, please login again."
         )
 
-    access_token = generate_access_token(user)
-    refresh_token = generate_refresh_token(user)
+    token_pair = rotate_token_pair(user)
+    return Response(data=token_pair, status=status.HTTP_201_CREATED)
+
+
+@api_view(["POST"])
+@permission_classes([IsAdminUser])
+def revoke_tokens_view(request):
+    serializer = RevokeTokensSerializer(data=request.data)
+    if serializer.is_valid():
+        users = User.objects.all()
+        shards = get_user_shards()
+        user_ids = serializer.validated_data.get("user_ids")
+        if user_ids is not None:
+            users = users.filter(id__in=user_ids)
+            shards = {get_user_shard(user_id) for user_id in user_ids}
+        issued_before = serializer.validated_data.get("issued_before")
+        if issued_before is not None:
+            users = users.filter(refresh_token_created_at__lt=issued_before)
+        revoked = sum(users.using(shard).revoke_tokens() for shard in shards)
+        return Response({"revoked": revoked})
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
 
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def admission_metrics_view(request):
     return Response(
-        data={
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-        },
-        status=status.HTTP_201_CREATED,
+        {name: dict(route_class.metrics) for name, route_class in route_classes.items()}
     )
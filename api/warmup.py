@@ -0,0 +1,53 @@
+import importlib
+
+import jwt
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connections
+from django.urls import get_resolver, reverse
+
+from .urls import urlpatterns
+
+
+HOT_MODULES = [
+    "rest_framework.renderers",
+    "rest_framework.parsers",
+    "rest_framework.negotiation",
+    "rest_framework.metadata",
+    "rest_framework.templatetags.rest_framework",
+    "api.views",
+    "api.serializers",
+    "api.authentication",
+]
+
+
+def warmup():
+    # Pays the one-off costs of the first /api/login/ and /api/me/ requests
+    # before the worker starts serving traffic. It may run in a master
+    # process before forking (gunicorn --preload), so it does not touch the
+    # database, see warm_connections.
+    for module in HOT_MODULES:
+        importlib.import_module(module)
+
+    get_resolver()
+    for pattern in urlpatterns:
+        reverse(f"api:{pattern.name}")
+
+    access_token = jwt.encode(
+        {"user_id": None}, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM
+    )
+    jwt.decode(
+        access_token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM]
+    )
+
+    make_password("warmup")
+
+
+def warm_connections():
+    # Opens and verifies this thread's connection to every user shard. Call it
+    # in each worker after the fork, from the thread that serves requests
+    # (gunicorn post_worker_init with sync workers), CONN_MAX_AGE keeps the
+    # connections open for the first requests.
+    for alias in settings.USER_SHARDS:
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT 1")
@@ -0,0 +1,4 @@
+def post_worker_init(worker):
+    from api.warmup import warm_connections
+
+    warm_connections()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from datetime import timedelta
 from pathlib import Path
 
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "api.middleware.AdmissionControlMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -55,6 +57,22 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "restapi.urls"
 
+# Per route class concurrency limits, requests that cannot start within
+# queue_timeout seconds (including time queued in front of the worker, taken
+# from X-Request-Start) are shed with 503.
+ADMISSION_CONTROL = {
+    "password": {
+        "views": ["api:login", "api:register"],
+        "max_concurrency": 4,
+        "queue_timeout": 2.0,
+    },
+    "token": {
+        "views": ["api:detail", "api:refresh", "api:logout"],
+        "max_concurrency": 32,
+        "queue_timeout": 1.0,
+    },
+}
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -73,6 +91,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "restapi.wsgi.application"
 
+# Run api.warmup.warmup when a worker loads the WSGI/ASGI application
+API_WARMUP = os.environ.get("API_WARMUP") == "1"
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -81,8 +102,49 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": 60,
+    }
+}
+
+# Users are spread over USER_SHARD_COUNT databases by a hash of their id, the
+# username directory lives in the default database.
+USER_SHARD_COUNT = int(os.environ.get("USER_SHARD_COUNT", 1))
+for shard in range(1, USER_SHARD_COUNT):
+    DATABASES[f"shard_{shard}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"db_shard_{shard}.sqlite3",
+        "CONN_MAX_AGE": 60,
     }
+USER_SHARDS = ["default"] + [f"shard_{shard}" for shard in range(1, USER_SHARD_COUNT)]
+USER_DIRECTORY_DATABASE = "default"
+
+# The refresh grace window relies on cache.add() being atomic across all
+# workers, so it uses its own shared cache. The database cache needs
+# createcachetable and costs a few queries per refresh, point it at memcached
+# in production. MAX_ENTRIES must hold every refresh within the grace
+# period (peak refreshes per second * grace seconds), or entries are culled
+# before they expire.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "refresh_grace": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "refresh_grace_cache",
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    },
+}
+
+# Applied to every new SQLite connection, see api.db.configure_sqlite_connection,
+# CONN_MAX_AGE keeps connections (and these PRAGMAs) across requests
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 268435456,
 }
+# Serialize refresh token writes through an in-process queue
+SQLITE_SERIALIZE_TOKEN_WRITES = False
 
 
 # Password validation
@@ -140,3 +202,5 @@ JWT_SECRET_KEY = "mysecretkey"
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_LIFETIME = timedelta(seconds=30)
 REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+REFRESH_TOKEN_GRACE_PERIOD = timedelta(seconds=10)
+REFRESH_TOKEN_GRACE_CACHE = "refresh_grace"
@@ -21,6 +21,12 @@ class MyUserAdmin(UserAdmin):
     fieldsets = UserAdmin.fieldsets + (
         ("Extra Fields", {"fields": ("refresh_token", "refresh_token_expires_at")}),
     )
+    actions = ("revoke_tokens",)
+
+    @admin.action(description="Revoke tokens of selected users")
+    def revoke_tokens(self, request, queryset):
+        revoked = queryset.revoke_tokens()
+        self.message_user(request, f"Revoked tokens of {revoked} users.")
 
 
 admin.site.register(MyUser, MyUserAdmin)
@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from users.sharding import get_user_shard, get_user_shards
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Revoke access and refresh tokens of users in a single UPDATE."
+
+    def add_arguments(self, parser):
+        parser.add_argument("user_ids", nargs="*", type=int)
+        parser.add_argument(
+            "--issued-before",
+            help="Revoke refresh tokens issued before this ISO 8601 datetime.",
+        )
+        parser.add_argument("--all", action="store_true", help="Revoke all users.")
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"]
+        issued_before = options["issued_before"]
+        if not (user_ids or issued_before or options["all"]):
+            raise CommandError("Please provide user ids, --issued-before or --all")
+
+        users = User.objects.all()
+        shards = get_user_shards()
+        if user_ids:
+            users = users.filter(id__in=user_ids)
+            shards = {get_user_shard(user_id) for user_id in user_ids}
+        if issued_before:
+            cutoff = parse_datetime(issued_before)
+            if cutoff is None:
+                raise CommandError(f"Invalid datetime: {issued_before}")
+            if timezone.is_naive(cutoff):
+                cutoff = timezone.make_aware(cutoff)
+            users = users.filter(refresh_token_created_at__lt=cutoff)
+
+        revoked = sum(users.using(shard).revoke_tokens() for shard in shards)
+        self.stdout.write(self.style.SUCCESS(f"Revoked tokens of {revoked} users."))
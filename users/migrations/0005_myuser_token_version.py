@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-19 19:36
+
+from django.db import migrations, models
+import users.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_myuser_refresh_token'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='myuser',
+            managers=[
+                ('objects', users.models.MyUserManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='myuser',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2 on 2026-10-19 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_myuser_token_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150, unique=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_userdirectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,13 +1,60 @@
 import uuid
 
-from django.contrib.auth.models import AbstractUser
+from django.conf import settings
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
 
+from .sharding import generate_sharded_uuid, get_user_shard, is_sharding_enabled
+
+
+class MyUserQuerySet(models.QuerySet):
+    def revoke_tokens(self):
+        return self.update(
+            token_version=models.F("token_version") + 1,
+            refresh_token_created_at=None,
+            refresh_token_expires_at=None,
+        )
+
+
+class MyUserManager(UserManager.from_queryset(MyUserQuerySet)):
+    def _create_user(self, username, email, password, **extra_fields):
+        if not is_sharding_enabled():
+            return super()._create_user(username, email, password, **extra_fields)
+
+        # The directory row allocates a globally unique id, which picks the shard.
+        username = self.model.normalize_username(username)
+        directory = UserDirectory.objects.db_manager(settings.USER_DIRECTORY_DATABASE)
+        entry = directory.create(username=username)
+        manager = self.db_manager(get_user_shard(entry.id))
+        try:
+            return super(MyUserManager, manager)._create_user(
+                username,
+                email,
+                password,
+                id=entry.id,
+                refresh_token=generate_sharded_uuid(entry.id),
+                **extra_fields,
+            )
+        except Exception:
+            entry.delete()
+            raise
+
 
 class MyUser(AbstractUser):
     refresh_token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     refresh_token_created_at = models.DateTimeField(null=True, blank=True)
     refresh_token_expires_at = models.DateTimeField(null=True, blank=True)
+    token_version = models.PositiveIntegerField(default=0, editable=False)
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = MyUserManager()
+
+    def __str__(self):
+        return self.username
+
+
+class UserDirectory(models.Model):
+    username = models.CharField(max_length=150, unique=True)
 
     def __str__(self):
         return self.username
@@ -0,0 +1,57 @@
+import uuid
+import zlib
+
+from django.conf import settings
+
+
+def is_sharding_enabled():
+    return len(settings.USER_SHARDS) > 1
+
+
+def get_user_shards():
+    return settings.USER_SHARDS
+
+
+def get_shard_index(user_id):
+    return zlib.crc32(str(user_id).encode()) % len(settings.USER_SHARDS)
+
+
+def get_user_shard(user_id):
+    return settings.USER_SHARDS[get_shard_index(user_id)]
+
+
+def get_username_shard(username):
+    if not is_sharding_enabled():
+        return settings.USER_SHARDS[0]
+
+    from .models import UserDirectory
+
+    user_id = (
+        UserDirectory.objects.using(settings.USER_DIRECTORY_DATABASE)
+        .filter(username=username)
+        .values_list("id", flat=True)
+        .first()
+    )
+    if user_id is None:
+        return None
+    return get_user_shard(user_id)
+
+
+def generate_sharded_uuid(user_id):
+    # The first byte of the token carries the shard index, so a refresh token
+    # lookup goes straight to the shard that holds it.
+    token = uuid.uuid4()
+    if not is_sharding_enabled():
+        return token
+    token_bytes = bytearray(token.bytes)
+    token_bytes[0] = get_shard_index(user_id)
+    return uuid.UUID(bytes=bytes(token_bytes))
+
+
+def get_refresh_token_shard(refresh_token):
+    if not is_sharding_enabled():
+        return settings.USER_SHARDS[0]
+    shard_index = refresh_token.bytes[0]
+    if shard_index >= len(settings.USER_SHARDS):
+        return None
+    return settings.USER_SHARDS[shard_index]